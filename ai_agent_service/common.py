@@ -0,0 +1,51 @@
+"""Settings and helpers shared by sqlagent.py and service.py."""
+
+import re
+
+import httpx
+
+# httpx drops idle connections after 5s by default; keep them for the whole
+# conversation so each turn reuses the socket to Ollama.
+OLLAMA_CLIENT_KWARGS = {
+    "timeout": 120,
+    "limits": httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=300),
+}
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # readers keep going while the writer commits
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",  # 64 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # read pages through a 256 MB mmap
+)
+
+def apply_pragmas(dbapi_conn, connection_record=None):
+    """SQLAlchemy "connect" listener; most pragmas are per connection."""
+    for pragma in SQLITE_PRAGMAS:
+        dbapi_conn.execute(pragma)
+
+# Quoted strings and numbers in a question. Questions that embed alike but ask
+# for "salary above 50000" vs "60000" must not share SQL.
+_PROMPT_LITERAL_RE = re.compile(r"""'[^']*'|"[^"]*"|\d+(?:\.\d+)?""")
+
+def prompt_literals(prompt):
+    """The literals a semantic cache hit must share with the cached question."""
+    return tuple(_PROMPT_LITERAL_RE.findall(prompt.lower()))
+
+def sql_complete(text):
+    """True once the streamed text holds a finished statement or a closed code fence."""
+    text = text.strip()
+    if text.startswith("```"):
+        return "```" in text[3:]
+    if not text.endswith(";"):
+        return False
+    # A ';' inside a string literal ('a;b') doesn't end the statement; an
+    # escaped '' just closes and reopens the quote.
+    quote = None
+    for char in text:
+        if quote is None:
+            if char in ("'", '"'):
+                quote = char
+        elif char == quote:
+            quote = None
+    return quote is None
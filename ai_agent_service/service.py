@@ -1,58 +1,295 @@
-<<<<<<< HEAD
 from operator import itemgetter
-from langchain.prompts import ChatMessagePromptTemplate, MessagesPlaceholder, ChatPromptTemplate, FewShotPromptTemplate, FewShotChatMessagePromptTemplate
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
-from langchain_community.embeddings import OllamaEmbeddings
 
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_community.utilities.sql_database import SQLDatabase
-from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
+from langchain_core.tools import BaseTool
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.messages import HumanMessage
 import re
-from langchain.chains.sql_database.query import create_sql_query_chain
-from langchain_chroma import Chroma
-from openai import OpenAI
+import numpy as np
+import asyncio
 import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
 
+from fastapi import FastAPI
+from pydantic import BaseModel
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 
-@functools.lru_cache(maxsize=1)
-def get_llm():
-    llm = ChatOllama(model="codellama")
+try:
+    from .common import OLLAMA_CLIENT_KWARGS, apply_pragmas, prompt_literals, sql_complete
+except ImportError:  # run as a script: python service.py
+    from common import OLLAMA_CLIENT_KWARGS, apply_pragmas, prompt_literals, sql_complete
+
+
+# Instruct-tuned code model in 4-bit K-quant: ~5x faster to decode than the
+# FP16 code models, and it can also write the natural-language answer.
+LLM_MODEL = os.environ.get("OLLAMA_SQL_MODEL", "deepseek-coder:6.7b-instruct-q4_K_M")
+# The same model by default, so a question keeps one chat model loaded
+# instead of swapping between two.
+ANSWER_MODEL = os.environ.get("OLLAMA_ANSWER_MODEL", LLM_MODEL)
+# A dedicated 768-dim sentence-embedding model; llama3 produced 4096-dim
+# vectors from an 8B decoder at a few hundred ms per call.
+EMBEDDINGS_MODEL = "nomic-embed-text"
+DB_PATH = "test.db"
+DB_URI = f"sqlite:///{DB_PATH}"
+SQL_CACHE_MATRIX_PATH = "sql_cache.npy"
+SQL_CACHE_SQLS_PATH = "sqls.jsonl"
+
+
+# temperature=0 keeps the SQL for a question stable, which also makes the
+# semantic cache hit more often; num_predict caps runaway generations.
+LLM_OPTIONS = {"temperature": 0, "num_ctx": 2048, "num_predict": 256}
+# Keep the model loaded between requests so its KV cache survives.
+OLLAMA_KEEP_ALIVE = "30m"
+
+# All factories are keyed by plain strings (model name, db URI) so the
+# lru_cache can hash them; every client, the SQLAlchemy reflection pass and
+# the runnable graph are therefore built once per process.
+@functools.lru_cache(maxsize=None)
+def get_llm(model=LLM_MODEL):
+    llm = ChatOllama(model=model, **LLM_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS)
     return llm
 
-@functools.lru_cache(maxsize=1)
-def get_sql_database():
-    # Create a SQLite database in memory
-    db = SQLDatabase.from_uri("sqlite:///test.db")
+@functools.lru_cache(maxsize=None)
+def get_sql_database(uri=DB_URI):
+    # Generated queries run on these pooled connections from executor threads;
+    # each sqlite3 connection keeps its own prepared-statement cache.
+    engine = create_engine(uri, poolclass=QueuePool, pool_size=8,
+                           connect_args={"check_same_thread": False, "cached_statements": 256})
+    # Most of these pragmas are per connection, so apply them to every pooled one.
+    event.listen(engine, "connect", apply_pragmas)
+    db = SQLDatabase(engine=engine)
     return db
 
+@functools.lru_cache(maxsize=None)
+def get_embeddings(model=EMBEDDINGS_MODEL):
+    return OllamaEmbeddings(model=model, client_kwargs=OLLAMA_CLIENT_KWARGS)
 
-def get_or_create_vectorstore(vectorstore_cls, collection_name="default"):
-    """Get or create a persistent vectorstore collection for caching."""
-    return vectorstore_cls(collection_name=collection_name)
-
-@functools.lru_cache(maxsize=1)
-def get_example_selector_cached(examples_tuple, embeddings_model_name, vectorstore_cls, k):
-    """Cache the example selector to avoid recomputation."""
-    # Convert tuple back to list of dicts
-    examples = [dict(zip(("input", "query"), ex)) for ex in examples_tuple]
-    embeddings = OllamaEmbeddings(model=embeddings_model_name)
-    vectorstore = get_or_create_vectorstore(vectorstore_cls)
-    return SemanticSimilarityExampleSelector.from_examples(
-        examples=examples,
-        embeddings=embeddings,
-        vectorstore_cls=vectorstore_cls,
-        k=k
-    )
 
-def create_few_shot_prompt(example_selector, sample_prompt):
-    return FewShotChatMessagePromptTemplate(
-        example_prompt=sample_prompt,
-        example_selector=example_selector,
-        output_parser=StrOutputParser(),
-    )
+# Spans where SQLite takes no parameter are matched first and kept verbatim:
+# binding "ORDER BY 1" would sort by a constant instead of the first column,
+# and an alias (AS 'Name'), a type (CAST(x AS DECIMAL(10, 2))) or a PRAGMA
+# value can't be a "?" at all.
+_SQL_LITERAL = re.compile(
+    r"""
+    (?P<keep>\A\s*PRAGMA\b.*
+      | \b(?:ORDER|GROUP)\s+BY\b.*?(?=\bLIMIT\b|\bOFFSET\b|\bHAVING\b|\bUNION\b|\)|;|$)
+      | \bAS\s+(?:'(?:[^']|'')*'|\w+(?:\s*\([^)]*\))?))
+    | (?P<str>'(?:[^']|'')*')
+    | (?P<num>(?<![\w.])\d+(?:\.\d+)?(?![\w.]))
+    """,
+    re.IGNORECASE | re.VERBOSE | re.DOTALL,
+)
+_SQL_DDL = re.compile(r"\s*(?:CREATE|ALTER|DROP)\b", re.IGNORECASE)
+
+
+class PreparedSQLCache:
+    """Execute SQL with its literals bound as parameters.
+
+    Queries that differ only in their literals share one statement text, so
+    each pooled sqlite3 connection reuses the prepared statement from its own
+    statement cache. The literal-to-placeholder rewrite of each raw query is
+    kept in an LRU shared by all executor threads.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.shapes = OrderedDict()  # raw sql -> (parameterized sql, params)
+        self.lock = threading.Lock()
+
+    def parameterize(self, sql):
+        with self.lock:
+            if sql in self.shapes:
+                self.shapes.move_to_end(sql)
+                return self.shapes[sql]
+        params = []
+
+        def bind(match):
+            if match.group("str") is not None:
+                params.append(match.group("str")[1:-1].replace("''", "'"))
+            elif match.group("num") is not None:
+                num = match.group("num")
+                params.append(float(num) if "." in num else int(num))
+            else:
+                return match.group("keep")
+            return "?"
+
+        shape = (_SQL_LITERAL.sub(bind, sql), tuple(params))
+        with self.lock:
+            self.shapes[sql] = shape
+            if len(self.shapes) > self.maxsize:
+                self.shapes.popitem(last=False)
+        return shape
+
+    def execute(self, conn, sql, params=()):
+        """Run sql on a DB-API connection and return its cursor."""
+        if _SQL_DDL.match(sql):
+            # Schema changes invalidate every cached shape.
+            with self.lock:
+                self.shapes.clear()
+        elif not params and "?" not in sql:
+            sql, params = self.parameterize(sql)
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+
+@functools.lru_cache(maxsize=None)
+def get_prepared_cache():
+    return PreparedSQLCache()
+
+
+class FastQuerySQLTool(BaseTool):
+    """Run SQL on a pooled sqlite3 connection, skipping SQLAlchemy's per-query setup."""
+
+    name: str = "sql_db_query"
+    description: str = "execute SQL query"
+    uri: str = DB_URI
+
+    def _run(self, query: str) -> str:
+        # Each call checks out its own connection, so concurrent requests run
+        # side by side instead of queueing on one shared connection.
+        conn = get_sql_database(self.uri)._engine.raw_connection()
+        try:
+            rows = get_prepared_cache().execute(conn, query).fetchall()
+            conn.commit()
+        except sqlite3.Error as e:
+            return f"Error: {e}"
+        finally:
+            conn.close()  # returns it to the pool, rolling back anything uncommitted
+        return str(rows) if rows else ""
+
+
+@functools.lru_cache(maxsize=None)
+def get_execute_tool(uri=DB_URI):
+    return FastQuerySQLTool(uri=uri)
+
+
+def _l2_normalize(vecs):
+    vecs = np.asarray(vecs, dtype="float32").reshape(-1, np.shape(vecs)[-1])
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+class SemanticSQLCache:
+    """Map question embeddings to the SQL previously generated for them.
+
+    Embeddings live in the leading rows of a preallocated float32 matrix that
+    doubles when full, so a lookup is a single matrix-vector product. A lookup
+    hits when the cosine similarity to a stored question is at least
+    ``threshold`` and both questions carry the same literals under the same
+    schema key: "salary above 50000" and "60000" clear the threshold but
+    need different SQL. Entries expire ``ttl`` seconds after being stored and the
+    least recently used one is evicted once ``maxsize`` entries are held.
+    """
+
+    def __init__(self, threshold=0.95, ttl=300, maxsize=1024, capacity=64,
+                 matrix_path=SQL_CACHE_MATRIX_PATH, sqls_path=SQL_CACHE_SQLS_PATH):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.capacity = capacity
+        self.matrix_path = matrix_path
+        self.sqls_path = sqls_path
+        self.mat = None  # rows [:size] hold the live embeddings
+        self.size = 0
+        self.sqls = []
+        self.literals = []
+        self.schema_keys = []
+        self.stored_at = []
+        self.last_used = []
+        self.load()
+
+    def get(self, q_embed, question, schema_key) -> Optional[str]:
+        self._expire()
+        if not self.size:
+            return None
+        vec = _l2_normalize(q_embed)[0]
+        if vec.shape[0] != self.mat.shape[1]:
+            return None
+        sims = self.mat[:self.size] @ vec
+        close = np.flatnonzero(sims >= self.threshold)
+        literals = prompt_literals(question)
+        for row in close[np.argsort(-sims[close])]:
+            if self.schema_keys[row] == schema_key and self.literals[row] == literals:
+                self.last_used[row] = time.time()
+                return self.sqls[row]
+        return None
+
+    def put(self, q_embed, sql, question, schema_key):
+        vec = _l2_normalize(q_embed)[0]
+        if self.mat is None or self.mat.shape[1] != vec.shape[0]:
+            # Vectors from a different embedding model are not comparable.
+            self.mat = np.empty((self.capacity, vec.shape[0]), dtype="float32")
+            self.size = 0
+            self.sqls, self.literals, self.schema_keys = [], [], []
+            self.stored_at, self.last_used = [], []
+        self._expire()
+        while self.size >= self.maxsize:
+            self._remove([min(range(self.size), key=self.last_used.__getitem__)])
+        if self.size == len(self.mat):
+            grown = np.empty((2 * len(self.mat), self.mat.shape[1]), dtype="float32")
+            grown[:self.size] = self.mat[:self.size]
+            self.mat = grown
+        now = time.time()
+        self.mat[self.size] = vec
+        self.sqls.append(sql)
+        self.literals.append(prompt_literals(question))
+        self.schema_keys.append(schema_key)
+        self.stored_at.append(now)
+        self.last_used.append(now)
+        self.size += 1
+        self.save()
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        expired = [row for row, stored_at in enumerate(self.stored_at) if stored_at < deadline]
+        if expired:
+            self._remove(expired)
+
+    def _remove(self, rows):
+        keep = np.ones(self.size, dtype=bool)
+        keep[rows] = False
+        kept = int(keep.sum())
+        self.mat[:kept] = self.mat[:self.size][keep]
+        self.sqls = [v for v, k in zip(self.sqls, keep) if k]
+        self.literals = [v for v, k in zip(self.literals, keep) if k]
+        self.schema_keys = [v for v, k in zip(self.schema_keys, keep) if k]
+        self.stored_at = [v for v, k in zip(self.stored_at, keep) if k]
+        self.last_used = [v for v, k in zip(self.last_used, keep) if k]
+        self.size = kept
+
+    def save(self):
+        np.save(self.matrix_path, self.mat[:self.size])
+        with open(self.sqls_path, "w") as f:
+            for row in zip(self.sqls, self.literals, self.schema_keys, self.stored_at, self.last_used):
+                f.write(json.dumps(dict(zip(("sql", "literals", "schema_key", "stored_at", "last_used"), row))) + "\n")
+
+    def load(self):
+        if not (os.path.exists(self.matrix_path) and os.path.exists(self.sqls_path)):
+            return
+        with open(self.sqls_path) as f:
+            rows = [json.loads(line) for line in f]
+        mat = np.load(self.matrix_path)
+        # Rows saved before literals and schema keys were stored can't be matched.
+        if len(mat) != len(rows) or any("schema_key" not in row for row in rows):
+            return
+        self.mat = np.empty((max(self.capacity, len(mat)), mat.shape[1]), dtype="float32")
+        self.mat[:len(mat)] = mat
+        self.size = len(rows)
+        self.sqls = [row["sql"] for row in rows]
+        self.literals = [tuple(row["literals"]) for row in rows]
+        self.schema_keys = [row["schema_key"] for row in rows]
+        self.stored_at = [row["stored_at"] for row in rows]
+        self.last_used = [row["last_used"] for row in rows]
+        self._expire()
 
 
 input_chat_prompt = PromptTemplate(
@@ -77,78 +314,178 @@ input_chat_prompt = PromptTemplate(
     )
 )
 
-    
-data = input("Enter your question: ")
+# top_k is fixed for this script, so bind it once instead of on every invoke.
+STATIC_PROMPT = input_chat_prompt.partial(top_k="3")
 
+# The answer prompt is a plain f-string rather than a PromptTemplate piped
+# into the LLM: one template and one model call don't need the
+# RunnableSequence config/callback machinery on every request.
+def answer_prefix(question, sql):
+    return (
+        "Given the following user question, corresponding User Question, and SQL result, answer the question with following results.\n"
+        f"    Question: {question}\n"
+        f"    SQL Query: {sql}\n"
+        "    SQL Result:"
+    )
 
-# Initialize the LLM
-llm = get_llm()
+async def rephrase(question, sql, result, llm_model=ANSWER_MODEL):
+    prompt = f"{answer_prefix(question, sql)} {result}\n Answer: "
+    response = await get_llm(llm_model).ainvoke([HumanMessage(content=prompt)])
+    return response.content
 
+async def warm_rephrase_prefix(question, sql, llm_model=ANSWER_MODEL):
+    """Prefill Ollama's KV cache with the part of the answer prompt known before the result."""
+    try:
+        # Same num_ctx as the real call, otherwise Ollama reloads the model
+        # instead of reusing the cached prefix.
+        await get_llm(llm_model).ainvoke([HumanMessage(content=answer_prefix(question, sql))], options={**LLM_OPTIONS, "num_predict": 1})
+    except Exception:
+        # Best effort only: rephrase() sends the full prompt either way.
+        pass
 
-db = get_sql_database()
+def get_schema_version(uri=DB_URI):
+    with get_sql_database(uri)._engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA schema_version").scalar()
 
+@functools.lru_cache(maxsize=None)
+def _build_query_chain(llm_model, uri, schema_version):
+    # create_sql_query_chain re-reads table_info on every invoke; the schema
+    # only changes when schema_version does, so bake it into the prompt here.
+    prompt = STATIC_PROMPT.partial(table_info=get_sql_database(uri).get_table_info())
+    return (
+        {"input": itemgetter("question")}
+        | prompt
+        | get_llm(llm_model).bind(stop=["\nSQLResult:"])
+        | StrOutputParser()
+    )
 
-query = create_sql_query_chain(llm=llm, db=db, prompt=input_chat_prompt)
+def get_query_chain(llm_model=LLM_MODEL, uri=DB_URI):
+    return _build_query_chain(llm_model, uri, get_schema_version(uri))
 
 
-response = query.invoke({"question": data, "top_k": 3})
-=======
-from math import e
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_ollama import ChatOllama
-from langchain_community.utilities.sql_database import SQLDatabase
-from langchain.agents import create_sql_agent
+# str.strip("```sql") strips any of the characters `, s, q, l from both ends
+# (eating e.g. the "l" of a trailing "NULL"); match the fence instead. An
+# unterminated fence (generation cut off) runs to the end of the text.
+_SQL_FENCE = re.compile(r"```(?:sql)?\s*(.*?)\s*(?:```|$)", re.DOTALL | re.IGNORECASE)
 
-from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
-from langchain.chains.sql_database.query import create_sql_query_chain
+def extract_sql(text):
+    match = _SQL_FENCE.search(text)
+    return (match.group(1) if match else text).strip()
 
-from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-llm = ChatOllama(model="llama3")
-db = SQLDatabase.from_uri("sqlite:///test.db")
-toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-agent = create_sql_agent(llm=llm, toolkit=toolkit, verbose=True)
+async def stream_sql(question):
+    """Stream the generated SQL and stop decoding as soon as the statement is complete."""
+    buf = ""
+    stream = get_query_chain().astream({"question": question})
+    try:
+        async for chunk in stream:
+            buf += chunk
+            if sql_complete(buf):
+                break
+    finally:
+        await stream.aclose()
+    return buf
 
-query = create_sql_query_chain(llm=llm, db=db)
 
+class SQLBatcher:
+    """Coalesce concurrent questions into a single abatch call on the query chain.
 
-out = query.invoke({"question" : "Employee's Highest salary"})
-print(out)
+    Questions queue up until ``max_batch`` are pending or ``max_wait`` seconds
+    have passed since the first one arrived; each caller awaits its own future.
+    """
 
-response = agent.invoke("Which Employee has the highest salary?")
->>>>>>> f5ffcca (changes)
-print(response)
-response = response.strip("```sql")
-execute_query = QuerySQLDatabaseTool(db=db, description="execute SQL query")
-# match = re.search(r"SQLQuery:\s*(.*)", response, re.IGNORECASE | re.DOTALL)
-output = execute_query.invoke(response)
-print(output)
+    def __init__(self, max_batch=8, max_wait=0.025):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = deque()
+        self.full = asyncio.Event()
+        self.flusher = None
 
-<<<<<<< HEAD
-answer_prompt = PromptTemplate(
-    input_variables=["input"],
-    template="""Given the following user question, corresponding User Question, and SQL result, answer the question with following results.
-    Question: {question}
-    SQL Query: {query}
-    SQL Result: {result}
- Answer: """
+    async def generate(self, question):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((question, future))
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush())
+        return await future
 
-)
+    async def _flush(self):
+        try:
+            await asyncio.wait_for(self.full.wait(), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        while self.pending:
+            self.full.clear()
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+            try:
+                results = await get_query_chain().abatch([{"question": q} for q, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                # A caller cancelled mid-batch (e.g. the client hung up) already
+                # has a done future; setting it would kill the flusher.
+                for (_, future), sql in zip(batch, results):
+                    if not future.done():
+                        future.set_result(sql)
+
+
+def _is_read_query(sql):
+    return sql.lstrip().upper().startswith(("SELECT", "WITH"))
+
+
+@functools.lru_cache(maxsize=None)
+def get_sql_cache():
+    return SemanticSQLCache()
+
+
+async def handle(question, batcher=None):
+    """Answer one question; SQL comes from the semantic cache, the batcher or a stream."""
+    sql_cache = get_sql_cache()
+    # The same schema version the query chain was built for.
+    schema_key = f"{DB_URI}#{get_schema_version()}"
+    question_embedding = await get_embeddings().aembed_query(question)
+    sql = sql_cache.get(question_embedding, question, schema_key)
+    cached = sql is not None
+    if not cached:
+        sql = await (batcher.generate(question) if batcher else stream_sql(question))
+        sql = extract_sql(sql)
+    execute_query = get_execute_tool()
+    warm_up = asyncio.create_task(warm_rephrase_prefix(question, sql))
+    result = await execute_query.ainvoke(sql)
+    await warm_up
+    # Only reads that ran are reused: two inserts differing in a name embed
+    # almost identically, and a failed statement would be replayed forever.
+    if not cached and _is_read_query(sql) and not result.startswith("Error:"):
+        sql_cache.put(question_embedding, sql, question, schema_key)
+
+    # Reuse the SQL and result from above rather than regenerating and
+    # re-executing the query inside the answer chain.
+    answer = await rephrase(question, sql, result)
+    return {"question": question, "sql": sql, "result": result, "answer": answer}
+
+
+class QuestionRequest(BaseModel):
+    question: str
+
+
+app = FastAPI(title="SQL Assistant")
+batcher = SQLBatcher()
+
+
+@app.post("/query")
+async def query_endpoint(request: QuestionRequest):
+    return await handle(request.question, batcher=batcher)
 
-rephrase_answer = answer_prompt | llm | StrOutputParser()
 
-chain = (
- RunnablePassthrough.assign(query=query).assign(
-     result=itemgetter("query") | execute_query
- )
- | rephrase_answer
- )
+async def main():
+    data = input("Enter your question: ")
+    response = await handle(data)
+    print(response["sql"])
+    print(response["result"])
+    print("Final Output: ", response["answer"])
 
-print("Final Output: ", chain.invoke({"question": data}))
-=======
-execute_query = QuerySQLDatabaseTool(db=db)
-response = execute_query.invoke("Which Employee has the highest salary?")
-print(response)
 
-chain = query | execute_query 
-response = chain.invoke({"question" : "Employee's Highest salary"})
->>>>>>> f5ffcca (changes)
+if __name__ == "__main__":
+    asyncio.run(main())
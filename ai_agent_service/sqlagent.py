@@ -1,31 +1,38 @@
+import asyncio
+import atexit
 import functools
+import hashlib
+import os
+from collections import OrderedDict
 from datetime import datetime
-import json
-from re import S
+from decimal import Decimal
+import orjson
 import re
-from turtle import st
-from typing import Annotated, Optional, TypedDict
-from urllib import response
-from venv import create
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Annotated, Any, Optional, TypedDict, Union
 
-from langchain_ollama import ChatOllama
-from langchain.chains.sql_database.query import create_sql_query_chain
+from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_community.utilities.sql_database import SQLDatabase
-from langchain.prompts import PromptTemplate, ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.messages import HumanMessage
 
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import StateGraph, add_messages
-
-from langchain_core.messages.tool import ToolCall
-from langchain_core.messages import ToolMessage
-from langchain_core.tools import BaseTool, tool
-from langchain.memory import ConversationBufferMemory
-from langchain.chains.llm import LLMChain
-from openai import BaseModel
-from sqlalchemy import table
-from sympy import O
-from yarl import Query
+from langgraph.graph import END, StateGraph, add_messages
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from sqlalchemy import MetaData, create_engine, event, text
+from sqlalchemy.pool import QueuePool
+import numpy as np
+import sqlglot
+from sqlglot import exp
+
+try:
+    from .common import OLLAMA_CLIENT_KWARGS, apply_pragmas, prompt_literals, sql_complete
+except ImportError:  # run as a script, e.g. by streamlit from chat_ui.py
+    from common import OLLAMA_CLIENT_KWARGS, apply_pragmas, prompt_literals, sql_complete
 
 class Employee(BaseModel):
     name: str
@@ -45,31 +52,401 @@ class State(TypedDict):
     messages : Annotated[list, add_messages]
     table: str
     query_type: str
-    partial_values: dict
+    partial_values: Union[dict, list[dict]]
+    where_clause: str
     missing_fields: list[str]
     Query: str
     message: str
     final_query: str
-    execution_result: str
+    execution_result: Any
+    error: str
+
+# Ollama's default devstral tag is already the Q4_K_M quantization; set
+# OLLAMA_AGENT_MODEL to pin a different quant (e.g. a q5_K_M or q8_0 tag).
+# service.py reads its own variables; its default model differs.
+LLM_MODEL = os.environ.get("OLLAMA_AGENT_MODEL", "devstral")
+OLLAMA_KEEP_ALIVE = "30m"
+# The rendered prompt (system text, schema with sample rows, question) is
+# about 1k tokens; a 2k window leaves room for the answer at half the KV
+# cache, and num_predict caps a generation that never reaches its ';'.
+LLM_OPTIONS = {"temperature": 0.5, "num_ctx": 2048, "num_predict": 256}
+QUERY_CACHE_PATH = "response_cache.db"
+DB_URI = "sqlite:///test.db"
+
+# Query types whose SQL is rebuilt from the validated values before running.
+_WRITE_QUERY_TYPES = frozenset({"insert", "update"})
+_WRITE_KEYWORD_RE = re.compile(r"\s*(?:insert|update)\b", re.I)
+
+def _sql_value(node):
+    """Python value of a literal SQL expression.
+
+    Raises ValueError for anything else (date('now'), CURRENT_DATE, a
+    subquery): bound as a parameter it would be stored as its SQL text.
+    """
+    value = node.to_py()
+    # sqlglot reads decimals as Decimal, which sqlite3 cannot bind.
+    return float(value) if isinstance(value, Decimal) else value
+
+@functools.lru_cache(maxsize=256)
+def _parse_write_query(query):
+    # Most turns are SELECTs; don't build a syntax tree just to discard it.
+    if not _WRITE_KEYWORD_RE.match(query):
+        return None
+    try:
+        tree = sqlglot.parse_one(query, dialect="sqlite")
+        return _write_values(tree)
+    except (sqlglot.errors.SqlglotError, ValueError):
+        # Unparseable, or a value only SQLite can compute: run the SQL as written.
+        return None
+
+def _write_values(tree):
+    if isinstance(tree, exp.Insert):
+        # Only the INSERT INTO t (cols) VALUES (...) form carries field values.
+        if not isinstance(tree.this, exp.Schema) or not isinstance(tree.expression, exp.Values):
+            return None
+        columns = [col.name for col in tree.this.expressions]
+        rows = tuple(
+            tuple(zip(columns, (_sql_value(v) for v in row.expressions)))
+            for row in tree.expression.expressions
+        )
+        return tree.this.this.name, "insert", rows, None
+    if isinstance(tree, exp.Update):
+        assignments = tuple((eq.this.name, _sql_value(eq.expression)) for eq in tree.expressions)
+        where = tree.args.get("where")
+        return tree.this.name, "update", (assignments,), where.this.sql(dialect="sqlite") if where else None
+    return None
+
+@functools.lru_cache(maxsize=None)
+def _rows_adapter(model):
+    """One list[model] validator per model, so a multi-row insert is validated in a single call."""
+    return TypeAdapter(list[model])
+
+
+@functools.lru_cache(maxsize=None)
+def _field_adapter(model, field):
+    """Validator for a single field's annotation."""
+    return TypeAdapter(model.model_fields[field].annotation)
+
+
+def _fitted_values(model, values):
+    """values, each in the form its field's type accepts; None if one fits neither way.
+
+    A value fits as parsed or as the text it came from: "hire_date 2024"
+    parses as the int 2024, which a str field only takes as "2024".
+    "salary greater than 50000" reads as the value "greater than 50000",
+    which the int check turns away.
+    """
+    fitted = {}
+    for field, value in values.items():
+        adapter = _field_adapter(model, field)
+        for candidate in (value, str(value)):
+            try:
+                adapter.validate_python(candidate)
+            except ValidationError:
+                continue
+            fitted[field] = candidate
+            break
+        else:
+            return None
+    return fitted
+
+
+@functools.lru_cache(maxsize=None)
+def _required_fields(model):
+    """Required field names of a model, in declaration order."""
+    return tuple(name for name, info in model.model_fields.items() if info.is_required())
+
+# "Insert a new employee with name 'John Doe', department HR and salary 70000"
+_INSERT_REQUEST_RE = re.compile(r"\s*(?:insert|add|create)\s+(?:an?\s+)?(?:new\s+)?(\w+)\s+with\s+(.+?)[\s.;]*", re.I | re.S)
+_FIELD_VALUE_RE = re.compile(
+    r"""\s*(\w+)(?:\s*[=:]\s*|\s+(?:of|is|as|to)\s+|\s+)"""
+    r"""('[^']*'|"[^"]*"|[^,;'"]+?)\s*(?:,\s*(?:and\s+)?|;|\s+and\s+|$)""",
+    re.I,
+)
+
+def _request_value(raw):
+    if raw[:1] in ("'", '"'):
+        return raw[1:-1]
+    for cast in (int, float):
+        try:
+            return cast(raw)
+        except ValueError:
+            pass
+    return raw
+
+def _parse_insert_request(prompt):
+    """(table word, {field: value}) for a templated insert request, else None.
+
+    Every character after "with" must be consumed as field/value pairs;
+    anything looser is left to the model.
+    """
+    match = _INSERT_REQUEST_RE.fullmatch(prompt)
+    if match is None:
+        return None
+    fields, text, pos = {}, match.group(2), 0
+    while pos < len(text):
+        pair = _FIELD_VALUE_RE.match(text, pos)
+        if pair is None or pair.end() == pos:
+            return None
+        fields[pair.group(1).lower()] = _request_value(pair.group(2).strip())
+        pos = pair.end()
+    return match.group(1).lower(), fields
+
+def _strip_sql_fences(result):
+    result = result.strip()
+    if result.startswith("```"):
+        result = result.lstrip("`").replace("sql", "", 1).strip()
+        result = result.rstrip("`").strip()
+    return result
+
+def _today():
+    """The date the SQL prompt carries; cached SQL may embed it as a literal."""
+    return datetime.now().strftime('%Y-%m-%d')
+
+# Bounds how many generations one event loop sends to Ollama at once. An
+# asyncio.Semaphore belongs to the first loop that waits on it, so each loop
+# gets its own.
+_LLM_SEMAPHORES = weakref.WeakKeyDictionary()
+
+def _llm_semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = _LLM_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = _LLM_SEMAPHORES[loop] = asyncio.Semaphore(5)
+    return semaphore
+
+@functools.lru_cache(maxsize=None)
+def _background_loop():
+    """The event loop every synchronous Chat.run call is driven on.
+
+    The cached Ollama clients keep connections open between turns and those
+    connections belong to the loop that opened them, so turns must not each
+    get a fresh loop from asyncio.run.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="sqlagent-loop", daemon=True)
+    thread.start()
+
+    async def cancel_pending():
+        # e.g. a prefix warm-up still waiting on Ollama at exit.
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop():
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_pending(), loop).result(timeout=5)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=5)
+
+    atexit.register(stop)
+    return loop
+
+class QueryCache:
+    """Exact-prompt LRU in front of a cosine-similarity lookup over prompt embeddings.
+
+    Only read queries are reused semantically: two insert requests that differ
+    only in a name embed almost identically but must not share SQL. A
+    semantic hit also needs the same literals in both prompts. Entries only
+    serve the day they were generated on, since the prompt includes today's
+    date. With a path, entries are also written to SQLite (capped, like
+    memory, at maxsize) and reloaded on startup.
+    """
+    def __init__(self, embeddings, threshold=0.95, maxsize=2048, path=None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.exact = OrderedDict()
+        self.matrix = None
+        self.sqls = []
+        self.schema_keys = []
+        self.literals = []
+        self.days = []
+        self.next_row = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.scans = 0
+        self.scan_seconds = 0.0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(response_cache)")]
+            if columns and "day" not in columns:
+                # Written before entries were scoped to a day; it's only a cache.
+                self.conn.execute("DROP TABLE response_cache")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "id INTEGER PRIMARY KEY, prompt TEXT NOT NULL, schema_hash TEXT NOT NULL, "
+                "day TEXT NOT NULL, response TEXT NOT NULL, embedding BLOB, access_time REAL NOT NULL, "
+                "UNIQUE (prompt, schema_hash, day))"
+            )
+            self.load()
+
+    @staticmethod
+    def normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32)
+        return vec / (np.linalg.norm(vec) or 1.0)
+
+    def get_exact(self, prompt, schema_key):
+        key = (prompt, schema_key, _today())
+        if key in self.exact:
+            self.exact.move_to_end(key)
+            self.exact_hits += 1
+            if self.conn is not None:
+                self.conn.execute(
+                    "UPDATE response_cache SET access_time = ? WHERE prompt = ? AND schema_hash = ? AND day = ?",
+                    (time.time(), *key),
+                )
+            return self.exact[key]
+        return None
+
+    def get_similar(self, vec, schema_key, prompt):
+        # The matrix is capped at maxsize rows, so this flat scan stays a single
+        # sub-millisecond matrix-vector product; no approximate index needed.
+        started = time.perf_counter()
+        sql = None
+        if self.sqls and vec.shape[0] == self.matrix.shape[1]:
+            scores = self.matrix[:len(self.sqls)] @ vec
+            close = np.flatnonzero(scores >= self.threshold)
+            literals, day = prompt_literals(prompt), _today()
+            for row in close[np.argsort(-scores[close])]:
+                if self.schema_keys[row] == schema_key and self.literals[row] == literals and self.days[row] == day:
+                    sql = self.sqls[row]
+                    break
+        self.scans += 1
+        self.scan_seconds += time.perf_counter() - started
+        if sql is None:
+            self.misses += 1
+        else:
+            self.semantic_hits += 1
+        return sql
+
+    def stats(self):
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "entries": len(self.exact),
+            "avg_lookup_ms": 1000 * self.scan_seconds / self.scans if self.scans else 0.0,
+        }
+
+    def get(self, prompt, schema_key):
+        """Return (sql, embedding); sql is None on a miss, embedding is None on an exact hit."""
+        sql = self.get_exact(prompt, schema_key)
+        if sql is not None:
+            return sql, None
+        vec = self.normalize(self.embeddings.embed_query(prompt))
+        return self.get_similar(vec, schema_key, prompt), vec
+
+    def discard(self, sql):
+        """Forget every entry that returned sql, e.g. after it failed to execute."""
+        for key in [key for key, cached in self.exact.items() if cached == sql]:
+            del self.exact[key]
+        for row, cached in enumerate(self.sqls):
+            if cached == sql:
+                # Never matches again; the ring overwrites the slot in turn.
+                self.schema_keys[row] = None
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM response_cache WHERE response = ?", (sql,))
+
+    def _remember(self, prompt, schema_key, day, sql, vec):
+        """Add an entry in memory; returns whether it joined the semantic tier."""
+        self.exact[(prompt, schema_key, day)] = sql
+        if len(self.exact) > self.maxsize:
+            self.exact.popitem(last=False)
+        if vec is None or not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            return False
+        if self.matrix is None:
+            self.matrix = np.empty((self.maxsize, vec.shape[0]), dtype=np.float32)
+        elif vec.shape[0] != self.matrix.shape[1]:
+            return False
+        # Fixed-size ring buffer: once full, the oldest row is overwritten (FIFO).
+        row = self.next_row
+        self.matrix[row] = vec
+        if row < len(self.sqls):
+            self.sqls[row] = sql
+            self.schema_keys[row] = schema_key
+            self.literals[row] = prompt_literals(prompt)
+            self.days[row] = day
+        else:
+            self.sqls.append(sql)
+            self.schema_keys.append(schema_key)
+            self.literals.append(prompt_literals(prompt))
+            self.days.append(day)
+        self.next_row = (row + 1) % self.maxsize
+        return True
+
+    def put(self, prompt, schema_key, sql, vec):
+        day = _today()
+        semantic = self._remember(prompt, schema_key, day, sql, vec)
+        if self.conn is None:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO response_cache (prompt, schema_hash, day, response, embedding, access_time) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (prompt, schema_key, day, sql, vec.tobytes() if semantic else None, time.time()),
+        )
+        # The table holds no more than memory does: load() could never read the rest.
+        self.conn.execute(
+            "DELETE FROM response_cache WHERE id NOT IN "
+            "(SELECT id FROM response_cache ORDER BY access_time DESC LIMIT ?)",
+            (self.maxsize,),
+        )
+
+    def load(self):
+        day = _today()
+        self.conn.execute("DELETE FROM response_cache WHERE day != ?", (day,))
+        rows = self.conn.execute(
+            "SELECT prompt, schema_hash, response, embedding FROM response_cache "
+            "ORDER BY access_time DESC LIMIT ?",
+            (self.maxsize,),
+        ).fetchall()
+        # Oldest first, so the most recently used entries end up newest in the LRU and ring.
+        for prompt, schema_key, sql, blob in reversed(rows):
+            vec = np.frombuffer(blob, dtype=np.float32) if blob is not None else None
+            self._remember(prompt, schema_key, day, sql, vec)
 
 class SQLAgent:
     @staticmethod
-    @functools.lru_cache(maxsize=1)
-    def get_llm():
-        llm = ChatOllama(model="devstral", temperature=0.5, num_ctx=4048, verbose=False, keep_alive=1)
+    @functools.lru_cache(maxsize=None)
+    def get_llm(model=LLM_MODEL):
+        # keep_alive pins the model (and its KV cache) in Ollama between turns;
+        # the old value of 1 second unloaded it after almost every request.
+        llm = ChatOllama(model=model, **LLM_OPTIONS, verbose=False, keep_alive=OLLAMA_KEEP_ALIVE,
+                         client_kwargs=OLLAMA_CLIENT_KWARGS)
         return llm    
     @staticmethod
-    @functools.lru_cache(maxsize=1)
+    @functools.lru_cache(maxsize=None)
     def get_sql_database():
-        db = SQLDatabase.from_uri("sqlite:///test.db")
+        # LIFO checkout hands back the most recently used connection, whose
+        # page cache is warmest; reads check one out per query. Each sqlite3
+        # connection also keeps its prepared statements, so repeated query
+        # shapes skip SQLite's parse and plan.
+        engine = create_engine(DB_URI, poolclass=QueuePool, pool_size=8, pool_use_lifo=True,
+                               connect_args={"check_same_thread": False, "timeout": 5,
+                                             "cached_statements": 256})
+        event.listen(engine, "connect", apply_pragmas)
+        db = SQLDatabase(engine=engine)
         return db
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_query_cache():
+        return QueryCache(OllamaEmbeddings(model="nomic-embed-text", keep_alive=30 * 60,
+                                            client_kwargs=OLLAMA_CLIENT_KWARGS), path=QUERY_CACHE_PATH)
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_shared_agent():
+        # Every Chat session drives the same agent: its write connection is
+        # lock-guarded and everything else on it is read-only after __init__.
+        return SQLAgent()
 
-    def __init__(self):
-        self.llm = self.get_llm()
-        self.db = self.get_sql_database()
-        self.tools = []
-        self.tool_names = [tool.name for tool in self.tools]
-        self.System_Prompt = f"""
+    # Nothing that changes per turn or per day belongs in the system prompt:
+    # Ollama reuses the KV cache only for a byte-identical prefix.
+    System_Prompt = """
                 You are a highly skilled data assistant designed to convert natural language requests into optimized SQL queries.
 
                 Your job is to ensure that the generated SQL is correct, efficient, and relevant to the user's intent, using the given database structure.
@@ -98,81 +475,233 @@ class SQLAgent:
                 - Return only valid SQL — no natural language, no surrounding text.
                 - Treat this prompt as an instruction, not a conversation.
 
-                Today's date: {datetime.now().strftime('%Y-%m-%d')}
                 Target user: Business analysts and data scientists (non-technical audience).
-                """.strip()
-        
-        self.DB_structure_prompt = PromptTemplate.from_template(
-            template=(
-                f"System : {self.System_Prompt}\n"
-                "You have access to a SQLite database. This is the database's table structure:\n\n"
-                "Database Info:\n"
-                "{table_info}\n"
-                "Available Tables: {table_names}\n\n"
-                "Your Task\n"
-                "Create a SQL query based on the provided database structure and the user's question. With available tables:"
-                "Your task is to write ONLY the SQL query to answer the following question."
-                "Do NOT include any explanations, comments, or code block formatting (no ``` or ```sql)."
-                "Only return the SQL query. No explanation, no markdown, no formatting.\n\n"
-                "{top_k} most relevant tables are shown above."
-                "Question: {input}"
-                "SQL Query:"
-            ))
-        
-        self.generated_query_chain = create_sql_query_chain(
-            llm=self.llm,
-            db=self.db,
-            prompt=self.DB_structure_prompt,
-        )
-        self.model_map = {
-            "employee": Employee,
-            "project": Project
-        }
+    """.strip()
+
+    DB_structure_prompt = ChatPromptTemplate.from_messages([
+        ("system", System_Prompt),
+        ("human",
+            "You have access to a SQLite database. This is the database's table structure:\n\n"
+            "Database Info:\n"
+            "{table_info}\n"
+            "Available Tables: {table_names}\n\n"
+            "Your Task\n"
+            "Create a SQL query based on the provided database structure and the user's question. With available tables:"
+            "Your task is to write ONLY the SQL query to answer the following question."
+            "Do NOT include any explanations, comments, or code block formatting (no ``` or ```sql)."
+            "Only return the SQL query. No explanation, no markdown, no formatting.\n\n"
+            "{top_k} most relevant tables are shown above.\n"
+            "Today's date: {date}\n"
+            "Question: {input}"
+            "SQL Query:"
+        ),
+    ])
+
+    model_map = {
+        "employee": Employee,
+        "project": Project
+    }
+
+    def __init__(self):
+        self.llm = self.get_llm()
+        self.db = self.get_sql_database()
+        self.tools = []
+        self.tool_names = [tool.name for tool in self.tools]
 
-        self.table_info = self.db.get_table_info()
-        self.table_names = self.db.get_usable_table_names()
+        table_info, table_names, self.schema_key = _schema_cache(self.db)
+        self.table_info = table_info
+        self.table_names = list(table_names)
+        # The prompt is rendered once; each turn only appends the date and the
+        # question, and the model is called directly instead of through a
+        # prompt | llm | parser sequence.
+        self._system_message, self._human_prefix = _prompt_prefix(self.db)
+        self._sql_llm = self.llm.bind(stop=["\nSQLResult:"])
+        # Writes go through one connection held for the agent's lifetime; the
+        # lock makes concurrent turns take turns on it.
+        self._conn = self.db._engine.connect()
+        self._conn_lock = threading.Lock()
+
+    @functools.cached_property
+    def query_cache(self):
+        # Opened on first generation: agents used only to run or insert SQL
+        # never load the cache file or its embedding matrix.
+        return self.get_query_cache()
+
+    def _query_messages(self, prompt):
+        human = f"{self._human_prefix}Today's date: {_today()}\nQuestion: {prompt}\nSQLQuery: SQL Query:"
+        return [self._system_message, HumanMessage(content=human)]
+
+    def cache_stats(self):
+        return self.query_cache.stats()
+
+    async def _stream_sql(self, prompt):
+        """Stream the generated SQL and stop decoding as soon as the statement is complete."""
+        buf = ""
+        stream = self._sql_llm.astream(self._query_messages(prompt))
+        try:
+            async for chunk in stream:
+                buf += chunk.content
+                if sql_complete(buf):
+                    break
+        finally:
+            await stream.aclose()
+        return buf
 
     def generate_query(self, prompt):
-        result = self.generated_query_chain.invoke({"question": prompt, "table_names": self.table_names, "top_k": 3})
-        result = result.strip()
-        if result.startswith("```"):
-            result = result.lstrip("`").replace("sql", "", 1).strip()
-            result = result.rstrip("`").strip()
+        cached, embedding = self.query_cache.get(prompt, self.schema_key)
+        if cached is not None:
+            return cached
+        result = self._sql_llm.invoke(self._query_messages(prompt)).content
+        result = _strip_sql_fences(result)
+        self.query_cache.put(prompt, self.schema_key, result, embedding)
         return result
 
-    def execute_query(self, query):
-        try:
-            result = self.db._execute(query)
-            json_response = json.dumps(result, indent=2)
-            return json_response
-        except Exception as e:
-            return f"Error executing query: {str(e)}"
+    async def agenerate_query(self, prompt):
+        cached = self.query_cache.get_exact(prompt, self.schema_key)
+        if cached is not None:
+            return cached
+        async with _llm_semaphore():
+            # Start generating while the prompt is embedded and looked up, so a
+            # cache miss costs max(embed, generate) rather than their sum; a
+            # semantic hit cancels the generation.
+            generation = asyncio.create_task(self._stream_sql(prompt))
+            try:
+                embedding = self.query_cache.normalize(await self.query_cache.embeddings.aembed_query(prompt))
+            except BaseException:
+                generation.cancel()
+                raise
+            cached = self.query_cache.get_similar(embedding, self.schema_key, prompt)
+            if cached is not None:
+                generation.cancel()
+                return cached
+            result = _strip_sql_fences(await generation)
+        self.query_cache.put(prompt, self.schema_key, result, embedding)
+        return result
+
+    def execute_query(self, query, params=None):
+        """Run a statement with bound parameters; returns rows as dicts or an error string."""
+        if query.lstrip().upper().startswith(("SELECT", "WITH")):
+            # Reads use their own pooled connection, so they run in parallel
+            # with each other and, under WAL, with the writer.
+            try:
+                with self.db._engine.connect() as conn:
+                    return [dict(row._mapping) for row in conn.execute(text(query), params or {})]
+            except Exception as e:
+                return f"Error executing query: {str(e)}"
+        return self._execute_write(text(query), params or {})
+
+    def insert_rows(self, table_name, rows):
+        """Insert rows through the reflected Core table; returns [] or an error string.
+
+        SQLAlchemy compiles the INSERT once per table and column set and reuses
+        it from its statement cache; a list of rows goes out as one executemany.
+        Table and column names come from the schema, not from generated SQL.
+        """
+        table = _reflected_tables(self.db).get(table_name.lower())
+        if table is None:
+            return f"Error executing query: unknown table {table_name}"
+        # Core silently drops parameters that aren't columns; report them instead.
+        unknown = set().union(*rows) - set(table.c.keys())
+        if unknown:
+            return f"Error executing query: no such column(s) {', '.join(sorted(unknown))} in {table_name}"
+        return self._execute_write(table.insert(), rows)
+
+    def execute_many(self, queries):
+        """Run (query, params) pairs in one transaction; returns the last statement's rows or an error string.
+
+        The batch commits once, or rolls back as a whole if any statement fails.
+        """
+        return self._execute_writes([(text(query), params or {}) for query, params in queries])
+
+    def _execute_write(self, statement, params):
+        return self._execute_writes([(statement, params)])
+
+    def _execute_writes(self, batch):
+        with self._conn_lock:
+            try:
+                rows = []
+                for statement, params in batch:
+                    result = self._conn.execute(statement, params)
+                    rows = [dict(row._mapping) for row in result] if result.returns_rows else []
+                self._conn.commit()
+                return rows
+            except Exception as e:
+                self._conn.rollback()
+                return f"Error executing query: {str(e)}"
+
+    async def aexecute_query(self, query, params=None):
+        # SQLite work runs on a worker thread so the event loop keeps serving
+        # other turns' LLM streams meanwhile.
+        return await asyncio.to_thread(self.execute_query, query, params)
+
+    async def ainsert_rows(self, table_name, rows):
+        return await asyncio.to_thread(self.insert_rows, table_name, rows)
+
+    async def aexecute_many(self, queries):
+        return await asyncio.to_thread(self.execute_many, queries)
+
+    def close(self):
+        conn = getattr(self, "_conn", None)
+        if conn is not None:
+            conn.close()
+            self._conn = None
+
+    def __del__(self):
+        self.close()
         
     def parse_insert_or_update_query(self, query):
-        columns = []
-        values = []
-        match = re.search(r'INSERT INTO (\w+)', query)
-        if match:
-            table = match.group(1)
-            col_match = re.search(r"\((.*?)\)\s+VALUES", query, re.IGNORECASE)
-            columns = [c.strip() for c in col_match.group(1).split(',')]
-            val_match = re.search(r"VALUES\s*\((.*?)\)", query, re.IGNORECASE)
-            values = [eval(v.strip()) for v in val_match.group(1).split(',')]
-            return table, "insert", dict(zip(columns, values))
-        match = re.search(r'UPDATE (\w+)', query)
-        if match:
-            table_name = match.group(1)
-            set_match = re.search(r"SET\s+(.*?)\s+WHERE", query, re.IGNORECASE | re.DOTALL)
-            assignments = set_match.group(1).split(',')
-            for pair in assignments:
-                key, val = pair.strip().split('=')
-                columns.append(key.strip())
-                values.append(eval(val.strip()))
-                return table_name, "update",dict(zip(columns, values))
-        return None
+        parsed = _parse_write_query(query)
+        if parsed is None:
+            return None
+        table, query_type, rows, where_clause = parsed
+        # Fresh dicts per call: the parse itself is cached and shared. A
+        # multi-row INSERT comes back as a list of rows; an UPDATE also
+        # carries its WHERE condition.
+        if len(rows) == 1:
+            return table, query_type, dict(rows[0]), where_clause
+        return table, query_type, [dict(row) for row in rows], where_clause
     
-    def validate_fields(self,values, model):
-        missing_fields = []
+    def parse_insert_request(self, prompt):
+        """Values for a plain "insert a new <table> with <field> <value>, ..." request.
+
+        Returns the same shape as parse_insert_or_update_query, or None when the
+        prompt doesn't fit the template, names an unknown table or field, or
+        gives a value its field's type rejects.
+        """
+        parsed = _parse_insert_request(prompt)
+        if parsed is None:
+            return None
+        table, values = parsed
+        if table not in self.model_map and table.endswith("s"):
+            table = table[:-1]
+        model = self.model_map.get(table)
+        if model is None or not values.keys() <= model.model_fields.keys():
+            return None
+        values = _fitted_values(model, values)
+        if values is None:
+            return None
+        return table, "insert", values, None
+
+    def validate_fields(self,values, model, query_type="insert"):
+        if query_type == "update":
+            # Only the SET columns are written; the rest of the row stays as it is.
+            invalid = [f for f, v in values.items() if f in model.model_fields and _fitted_values(model, {f: v}) is None]
+            return invalid, None
+        # Absent required keys are found without running the validator; pydantic
+        # only sees values once every required field is there.
+        rows = values if isinstance(values, list) else [values]
+        missing_fields = [f for f in _required_fields(model) if any(f not in row for row in rows)]
+        if missing_fields:
+            return missing_fields, None
+        if isinstance(values, list):
+            try:
+                return [], _rows_adapter(model).validate_python(values)
+            except ValidationError as e:
+                # loc is (row index, field); ask for each field once for all rows.
+                for err in e.errors():
+                    if err['loc'][1] not in missing_fields:
+                        missing_fields.append(err['loc'][1])
+                return missing_fields, e
         try:
             instance = model(**values)
             return [], instance
@@ -182,34 +711,142 @@ class SQLAgent:
             return missing_fields, e
 
     def generate_final_sql(self, data, table: str, query_type="insert", where_clause=None):
-        columns = ", ".join(data.keys())
-        values = ", ".join([f"'{v}'" if isinstance(v, str) else str(v) for v in data.values()])
+        """Return (sql, params); values are bound by the driver rather than inlined.
+
+        For a list of rows, params is a list with one dict per row, run as an executemany.
+        """
+        query_type = query_type.lower()
+        rows = data if isinstance(data, list) else None
+        if rows is not None:
+            data = rows[0]
+        columns, params = [], {}
+        for i, (col, val) in enumerate(data.items()):
+            columns.append(col)
+            params[f"p{i}"] = val
+        if rows is not None:
+            params = [{f"p{i}": row.get(col) for i, col in enumerate(columns)} for row in rows]
         
-        if query_type.lower() == "insert":
-            return f"INSERT INTO {table} ({columns}) VALUES ({values});"
+        if query_type == "insert":
+            return _write_sql(table, query_type, tuple(columns)), params
         
-        elif query_type.lower() == "update":
-            set_clause = ", ".join([f"{col} = '{val}'" if isinstance(val, str) else f"{col} = {val}" for col, val in data.items()])
+        elif query_type == "update":
             if not where_clause:
                 raise ValueError("WHERE clause required for safe update.")
-            return f"UPDATE {table} SET {set_clause} WHERE {where_clause};"
+            return _write_sql(table, query_type, tuple(columns), where_clause), params
         
-        elif query_type.lower() == "select":
+        elif query_type == "select":
             where_clause = where_clause or "1=1"
-            return f"SELECT * FROM {table} WHERE {where_clause};"
+            return f"SELECT * FROM {table} WHERE {where_clause};", {}
 
-        elif query_type.lower() == "delete":
+        elif query_type == "delete":
             if not where_clause:
                 raise ValueError("WHERE clause required for safe delete.")
-            return f"DELETE FROM {table} WHERE {where_clause};"
+            return f"DELETE FROM {table} WHERE {where_clause};", {}
         
         else:
             raise ValueError("Only 'insert' or 'update' supported.")
         
+@functools.lru_cache(maxsize=256)
+def _write_sql(table, query_type, columns, where_clause=None):
+    """SQL text for one statement shape; the same string each time keeps SQLite's statement cache hitting."""
+    if query_type == "insert":
+        placeholders = ", ".join(f":p{i}" for i in range(len(columns)))
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders});"
+    assignments = ", ".join(f"{col} = :p{i}" for i, col in enumerate(columns))
+    return f"UPDATE {table} SET {assignments} WHERE {where_clause};"
+
+@functools.lru_cache(maxsize=None)
+def _schema_cache(db):
+    """Reflect the schema once per database instead of once per SQLAgent."""
+    table_info = db.get_table_info()
+    table_names = tuple(db.get_usable_table_names())
+    schema_key = hashlib.sha1(f"{table_info}|{list(table_names)}".encode()).hexdigest()
+    return table_info, table_names, schema_key
+
+@functools.lru_cache(maxsize=None)
+def _reflected_tables(db):
+    """Reflect the usable tables once, keyed by lower-cased name."""
+    metadata = MetaData()
+    metadata.reflect(bind=db._engine, only=list(db.get_usable_table_names()))
+    return {name.lower(): table for name, table in metadata.tables.items()}
+
+@functools.lru_cache(maxsize=None)
+def _prompt_prefix(db):
+    """The static part of the SQL prompt: the system message and the human text up to the date."""
+    table_info, table_names, _ = _schema_cache(db)
+    system, human = SQLAgent.DB_structure_prompt.format_messages(
+        table_info=table_info, table_names=list(table_names), top_k=3, date="", input="")
+    return system, human.content[:human.content.index("Today's date:")]
+
+# Databases whose prompt prefix Ollama already holds. Only a successful
+# prefill is recorded, so a failed one is retried on a later turn.
+_WARMED_PREFIXES = set()
+
+async def _warm_prompt_prefix(db):
+    """Prefill Ollama's KV cache with the static system prompt and schema, once per process."""
+    if db in _WARMED_PREFIXES:
+        return
+    system, prefix = _prompt_prefix(db)
+    try:
+        # Same num_ctx as the real calls, otherwise Ollama reloads the model
+        # instead of reusing the cached prefix. get_llm() with no argument, as
+        # in SQLAgent.__init__, so this shares the real calls' client.
+        await SQLAgent.get_llm().ainvoke([system, HumanMessage(content=prefix)], options={**LLM_OPTIONS, "num_predict": 1})
+    except Exception:
+        # Ollama isn't reachable yet; this turn's generation prefills instead.
+        return
+    _WARMED_PREFIXES.add(db)
+
+def _rows_failing(model, rows, field):
+    """Indices of the rows whose field is missing or fails validation."""
+    try:
+        _rows_adapter(model).validate_python(rows)
+    except ValidationError as e:
+        # loc is (row index, field, ...).
+        return {err["loc"][0] for err in e.errors() if err["loc"][1:2] == (field,)}
+    return set()
+
+def _has_missing_fields(state: State):
+    return bool(state.get("missing_fields"))
+
+def _parse_outcome(state: State):
+    if state.get("error"):
+        return "error"
+    return "missing" if _has_missing_fields(state) else "complete"
+
+# A thread's checkpoint outlives the turn: any turn that doesn't end in a
+# write must clear what an earlier insert/update left, or the next
+# generate_and_execute would run that write again.
+_NO_WRITE = {"table": "", "query_type": "select", "partial_values": {}, "where_clause": "", "missing_fields": []}
+
+_CANCEL_RE = re.compile(r"\s*(?:cancel|exit|quit|stop|abort|never\s*mind)\b[\s,.;:!-]*", re.I)
+_NEW_REQUEST_RE = re.compile(
+    r"\s*(?:show|list|get|find|select|insert|add|create|update|delete|remove|count|how|what|which|who)\b", re.I)
+
+def _abandoned_for(state: State, reply):
+    """The request a reply to a missing-field question turns to instead, or None if it answers it.
+
+    "cancel" alone gives ""; "never mind, show all projects" gives "show all
+    projects". A reply the field's type rejects and that reads like a request
+    is taken as one, so an int field can't hold the thread forever.
+    """
+    cancel = _CANCEL_RE.match(reply)
+    if cancel:
+        return reply[cancel.end():].strip()
+    model = SQLAgent.model_map[state["table"].lower()]
+    if _NEW_REQUEST_RE.match(reply) and _fitted_values(model, {state["missing_fields"][0]: reply}) is None:
+        return reply
+    return None
+
 class Chat:
     def __init__(self, state: State = None):
         self.llm = SQLAgent.get_llm()
-        self.agent = SQLAgent()
+        self.agent = SQLAgent.get_shared_agent()
+        self._warm_up = None
+        if self.agent.db not in _WARMED_PREFIXES:
+            # Prefill while the user types the first question. It runs on the
+            # loop that drives run(), so it shares that loop's Ollama client.
+            self._warm_up = asyncio.run_coroutine_threadsafe(_warm_prompt_prefix(self.agent.db), _background_loop())
         self.memory = MemorySaver()
         self.graph = StateGraph(State)
         self.graph.add_node("parse_and_validate", self.parse_and_validate_node)
@@ -221,7 +858,16 @@ class Chat:
 
         self.graph.add_conditional_edges(
             "parse_and_validate",
-            lambda state: "missing_fields" in state and len(state["missing_fields"]) > 0,
+            _parse_outcome,
+            {
+                "error": END,
+                "missing": "ask_missing_field",
+                "complete": "generate_and_execute"
+            }
+        )
+        self.graph.add_conditional_edges(
+            "update_context",
+            _has_missing_fields,
             {
                 True: "ask_missing_field",
                 False: "generate_and_execute"
@@ -229,10 +875,11 @@ class Chat:
         )
 
         self.graph.add_edge("ask_missing_field", "update_context")
-        self.graph.add_edge("update_context", "parse_and_validate")
 
         self.graph.set_finish_point("generate_and_execute")
-        self.runner = self.graph.compile(checkpointer=self.memory)
+        # Pause after asking for a field; the user's next message resumes the
+        # run at update_context instead of starting over with a new generation.
+        self.runner = self.graph.compile(checkpointer=self.memory, interrupt_before=["update_context"])
 
     def ask_for_missing_field_node(self, state: State):
         missing_fields = state.get("missing_fields", [])
@@ -242,30 +889,43 @@ class Chat:
         next_field = missing_fields[0]
         return {"message": f"Please provide a value for the missing field: {next_field}"}
         
-    def parse_and_validate_node(self, state: State):
+    async def parse_and_validate_node(self, state: State):
 
         user_message = state["messages"][-1].content
         
-        query = self.agent.generate_query(user_message)
-        parsed = self.agent.parse_insert_or_update_query(query)
+        # Templated inserts carry their values in the text; skip the model.
+        parsed = self.agent.parse_insert_request(user_message)
+        if parsed:
+            query = ""
+        else:
+            query = await self.agent.agenerate_query(user_message)
+            parsed = self.agent.parse_insert_or_update_query(query)
         
         if parsed:
-            table, query_type, values = parsed
+            table, query_type, values, where_clause = parsed
             model = self.agent.model_map.get(table.lower())
             if not model:
-                return {"error": f"No model for table {table}"}
+                # Ends the run; the message stands in for this turn's result.
+                error = f"No model for table {table}"
+                return {**_NO_WRITE, "error": error, "Query": query, "final_query": query,
+                        "execution_result": f"Error: {error}"}
             
-            missing, _ = self.agent.validate_fields(values, model)
+            missing, _ = self.agent.validate_fields(values, model, query_type)
             
             return {
                 "table": table,
                 "query_type": query_type,
                 "partial_values": values,
-                "missing_fields": missing
+                "where_clause": where_clause or "",
+                "missing_fields": missing,
+                "Query": query,
+                "error": "",
             }
         return {
+            **_NO_WRITE,
             "info": "Unable to parse query",
             "Query": query,
+            "error": "",
             }
     
     def update_context_with_user_input_node(self, state: State):
@@ -273,26 +933,47 @@ class Chat:
         last_missing = state["missing_fields"][0]
         
         updated_values = state.get("partial_values", {})
-        updated_values[last_missing] = user_response
+        model = self.agent.model_map[state["table"].lower()]
+        if isinstance(updated_values, list):
+            # One answer fills the field in every row where it's missing or invalid.
+            rows = _rows_failing(model, updated_values, last_missing)
+            updated_values = [
+                {**row, last_missing: user_response} if i in rows else row
+                for i, row in enumerate(updated_values)
+            ]
+        else:
+            updated_values = dict(updated_values)
+            updated_values[last_missing] = user_response
         
-        model = self.agent.model_map[state["table"]]
-        new_missing, _ = self.agent.validate_fields(updated_values, model)
+        new_missing, _ = self.agent.validate_fields(updated_values, model, state["query_type"])
         
         return {
             "partial_values": updated_values,
             "missing_fields": new_missing
         }
     
-    def generate_and_execute_final_query_node(self, state: State):
+    async def generate_and_execute_final_query_node(self, state: State):
         
         query_type = state.get("query_type", "select")
         final_query = state.get("Query","")
-        if query_type.lower() in ["insert", "update"]:
+        params = None
+        if query_type.lower() in _WRITE_QUERY_TYPES:
             table = state["table"]
             data = state["partial_values"]
         
-            final_query = self.agent.generate_final_sql(data, table, query_type)
-        execution_result = self.agent.execute_query(final_query)
+            try:
+                final_query, params = self.agent.generate_final_sql(data, table, query_type, state.get("where_clause"))
+            except ValueError as e:
+                # An UPDATE without a WHERE would rewrite every row.
+                return {"final_query": state.get("Query", ""), "execution_result": f"Error: {e}"}
+        if query_type.lower() == "insert":
+            rows = data if isinstance(data, list) else [data]
+            execution_result = await self.agent.ainsert_rows(table, rows)
+        else:
+            execution_result = await self.agent.aexecute_query(final_query, params)
+        if isinstance(execution_result, str) and execution_result.startswith("Error executing query") and state.get("Query"):
+            # Don't let a bad generation be replayed for this or a similar question.
+            self.agent.query_cache.discard(state["Query"])
         
         return {
             "final_query": final_query,
@@ -300,20 +981,43 @@ class Chat:
         }
     
     def run(self, thread_id: str, user_input: str = "List all employees with salary greater than 50000."):
+        return asyncio.run_coroutine_threadsafe(self.arun(thread_id, user_input), _background_loop()).result()
+
+    async def arun(self, thread_id: str, user_input: str = "List all employees with salary greater than 50000."):
         print("Start chatting with the SQL Agent. Type 'exit' to quit.\n")
-        result = self.runner.invoke(
-            {
-                "messages": [{"role": "user", "content": user_input}]
-            },
-            {
-                "configurable" : {
-                    "thread_id": "1",
-                }
+        config = {
+            "configurable" : {
+                "thread_id": thread_id,
             }
-        )
+        }
+        message = {"messages": [{"role": "user", "content": user_input}]}
+        snapshot = await self.runner.aget_state(config)
+        request = _abandoned_for(snapshot.values, user_input) if snapshot.next == ("update_context",) else None
+        if request is not None:
+            # Drop the pending write as if its run had finished; anything
+            # after the cancel word starts a fresh turn.
+            await self.runner.aupdate_state(config, {**_NO_WRITE, "execution_result": "Cancelled."},
+                                            as_node="generate_and_execute")
+            if request:
+                result = await self.runner.ainvoke({"messages": [{"role": "user", "content": request}]}, config)
+            else:
+                result = (await self.runner.aget_state(config)).values
+        elif snapshot.next == ("update_context",):
+            # This message answers the missing-field question.
+            await self.runner.aupdate_state(config, message)
+            result = await self.runner.ainvoke(None, config)
+        else:
+            result = await self.runner.ainvoke(message, config)
+        if (await self.runner.aget_state(config)).next:
+            # Still waiting on a field: show the question, not the last turn's rows.
+            result = dict(result)
+            result["execution_result"] = result.get("message", "")
+        # Rows stay native Python inside the graph; the UI expects JSON text.
+        if isinstance(result, dict) and isinstance(result.get("execution_result"), list):
+            result = dict(result)
+            result["execution_result"] = orjson.dumps(result["execution_result"], option=orjson.OPT_INDENT_2, default=str).decode()
         # Serialize messages if present in result
         if isinstance(result, dict) and "messages" in result:
-            from langchain_core.messages.base import BaseMessage
             serialized = dict(result)
             serialized["messages"] = [
                 {"role": getattr(msg, 'type', 'user'), "content": getattr(msg, 'content', str(msg))}
@@ -323,6 +1027,14 @@ class Chat:
             return serialized
         return result
 
+    async def arun_many(self, turns):
+        """Run (thread_id, user_input) turns concurrently; results come back in order.
+
+        Each thread keeps its own checkpoint, and _llm_semaphore() bounds how
+        many generations reach the model server at once.
+        """
+        return await asyncio.gather(*(self.arun(thread_id, user_input) for thread_id, user_input in turns))
+
 
 if __name__ == "__main__":
     # Example usage
@@ -1,23 +1,27 @@
+import functools
+
 from transformers import pipeline
 import gradio as gr
 
-summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
-translator = pipeline("translation_en_to_fr", model="Helsinki-NLP/opus-mt-en-fr")
-classifier = pipeline("sentiment-analysis")
+# Models load on first use rather than at import, so importing this module
+# (or opening the UI) doesn't wait on three model downloads/loads.
+@functools.lru_cache(maxsize=None)
+def get_pipeline(task, model=None):
+    return pipeline(task, model=model)
 
 def summarize(message: str, history) -> str:
     """Summarize the input text using a pre-trained model."""
     if len(message) < 50:
         return "Text too short to summarize."
-    return summarizer(message)[0]["summary_text"]
+    return get_pipeline("summarization", "facebook/bart-large-cnn")(message)[0]["summary_text"]
 
 def translate(message: str, history) -> str:
     """Translate the input text from English to French using a pre-trained model."""
-    return translator(message)[0]["translation_text"]
+    return get_pipeline("translation_en_to_fr", "Helsinki-NLP/opus-mt-en-fr")(message)[0]["translation_text"]
 
 def classify(message: str, history) -> str:
     """Classify the sentiment of the input text using a pre-trained model."""
-    return classifier(message)[0]["label"]
+    return get_pipeline("sentiment-analysis")(message)[0]["label"]
 
 gr_summarize = gr.ChatInterface(
     fn=summarize,
@@ -48,4 +52,5 @@ with gr.Blocks() as demo:
     with gr.Tab("Sentiment Analysis"):
         gr_classify.render()
 
-demo.launch(mcp_server=True)
\ No newline at end of file
+if __name__ == "__main__":
+    demo.launch(mcp_server=True)
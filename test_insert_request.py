@@ -0,0 +1,49 @@
+"""
+Tests for the templated insert-request parser
+"""
+
+from ai_agent_service.sqlagent import Employee, _fitted_values, _parse_insert_request
+
+
+def test_parses_quoted_and_bare_values():
+    table, values = _parse_insert_request(
+        "Insert a new employee with name 'John Doe', department HR and salary 70000"
+    )
+    assert table == "employee"
+    assert values == {"name": "John Doe", "department": "HR", "salary": 70000}
+
+
+def test_separators_and_trailing_punctuation():
+    table, values = _parse_insert_request(
+        'add employee with name = "Jane, Jr.", department: Sales; salary of 55000.'
+    )
+    assert table == "employee"
+    assert values == {"name": "Jane, Jr.", "department": "Sales", "salary": 55000}
+
+
+def test_non_template_prompts_are_left_to_the_model():
+    assert _parse_insert_request("Show all employees with salary greater than 50000") is None
+    assert _parse_insert_request("Add employee") is None
+    assert _parse_insert_request("Add employee with 'John'") is None
+
+
+def test_value_failing_the_field_type_is_rejected():
+    table, values = _parse_insert_request("Add employee with salary greater than 50000")
+    assert values == {"salary": "greater than 50000"}
+    assert _fitted_values(Employee, values) is None
+
+
+def test_values_matching_field_types_fit():
+    values = {"name": "John Doe", "salary": 70000}
+    assert _fitted_values(Employee, values) == values
+    assert _fitted_values(Employee, {"salary": "70000"}) == {"salary": "70000"}
+
+
+def test_number_for_a_text_field_is_kept_as_text():
+    table, values = _parse_insert_request(
+        "Add employee with name Bob, department HR, salary 5000 and hire_date 2024"
+    )
+    assert values["hire_date"] == 2024
+    fitted = _fitted_values(Employee, values)
+    assert fitted == {"name": "Bob", "department": "HR", "salary": 5000, "hire_date": "2024"}
+    Employee(**fitted)
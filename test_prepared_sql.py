@@ -0,0 +1,68 @@
+"""
+Tests for binding SQL literals as parameters
+"""
+
+import sqlite3
+
+import pytest
+
+from ai_agent_service.service import PreparedSQLCache
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE employee (name TEXT, department TEXT, salary INTEGER)")
+    conn.execute("INSERT INTO employee VALUES ('Ann', 'HR', 60000), ('O''Neil', 'IT', 40000)")
+    yield conn
+    conn.close()
+
+
+def test_where_and_limit_literals_are_bound():
+    sql, params = PreparedSQLCache().parameterize(
+        "SELECT name FROM employee WHERE department = 'HR' AND salary > 50000.5 LIMIT 10"
+    )
+    assert sql == "SELECT name FROM employee WHERE department = ? AND salary > ? LIMIT ?"
+    assert params == ("HR", 50000.5, 10)
+
+
+def test_escaped_quote_is_unescaped():
+    sql, params = PreparedSQLCache().parameterize("SELECT * FROM employee WHERE name = 'O''Neil'")
+    assert sql == "SELECT * FROM employee WHERE name = ?"
+    assert params == ("O'Neil",)
+
+
+def test_queries_differing_in_literals_share_a_shape():
+    cache = PreparedSQLCache()
+    first = cache.parameterize("SELECT * FROM employee WHERE salary > 50000")
+    second = cache.parameterize("SELECT * FROM employee WHERE salary > 60000")
+    assert first[0] == second[0]
+    assert (first[1], second[1]) == ((50000,), (60000,))
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT name FROM employee ORDER BY 1 DESC",
+    "SELECT department, COUNT(*) FROM employee GROUP BY 1",
+    "SELECT name AS 'Employee Name' FROM employee",
+    "SELECT CAST(salary AS DECIMAL(10, 2)) AS pay FROM employee",
+    "PRAGMA cache_size = -64000",
+])
+def test_positions_sqlite_cannot_bind_stay_verbatim(sql):
+    assert PreparedSQLCache().parameterize(sql) == (sql, ())
+
+
+def test_digits_inside_identifiers_stay():
+    sql, params = PreparedSQLCache().parameterize("SELECT col2 FROM t1 WHERE id1 = 3")
+    assert sql == "SELECT col2 FROM t1 WHERE id1 = ?"
+    assert params == (3,)
+
+
+def test_rewritten_queries_run(conn):
+    cache = PreparedSQLCache()
+    rows = cache.execute(
+        conn,
+        "SELECT name AS 'Employee Name', CAST(salary AS DECIMAL(10, 2)) AS pay "
+        "FROM employee WHERE salary > 50000 ORDER BY 1",
+    ).fetchall()
+    assert rows == [("Ann", 60000)]
+    assert cache.execute(conn, "PRAGMA cache_size = -2000").fetchall() == []